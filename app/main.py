@@ -1,20 +1,24 @@
 import os
 import shutil
 import uuid
+import base64
+import hashlib
+import concurrent.futures
+from collections import OrderedDict, deque
 from pathlib import Path
-from typing import List, Optional
+from typing import Awaitable, Callable, Iterator, List, Optional
 import httpx
+import numpy as np
+import orjson
 import chromadb
 from chromadb.config import Settings
 from fastapi import FastAPI, File, UploadFile, Form, Request, HTTPException
 from fastapi.responses import StreamingResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-import pdfplumber
-import docx
+from starlette.concurrency import run_in_threadpool
+from parsers import extract_pdf, extract_docx
 from PIL import Image
-import io
-import json
 import asyncio
 
 app = FastAPI()
@@ -32,12 +36,33 @@ app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 # Jinja2 templates
 templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
 
-# ChromaDB setup
-chroma_client = chromadb.PersistentClient(
-    path=str(BASE_DIR / "chroma_db"),
-    settings=Settings(anonymized_telemetry=False)
-)
-collection = chroma_client.get_or_create_collection(name="utas_documents")
+# ChromaDB setup (client and collection are opened in the startup hook)
+CHROMA_DIR = BASE_DIR / "chroma_db"
+chroma_client = None
+collection = None
+# HNSW index settings for new collections: cosine distance, and search_ef raised
+# from Chroma's default of 10 to 64 for better recall at a small query-time cost.
+# M and construction_ef are Chroma's defaults.
+COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 16,
+    "hnsw:construction_ef": 100,
+    "hnsw:search_ef": 64
+}
+
+
+def _open_collection(name: str):
+    """Open an existing collection as-is, or create it with COLLECTION_METADATA."""
+    # Never pass metadata for an existing collection: older chromadb versions overwrite
+    # it on get_or_create without rebuilding the index (an L2 index labelled cosine)
+    try:
+        return chroma_client.get_collection(name=name)
+    except Exception:
+        return chroma_client.create_collection(name=name, metadata=COLLECTION_METADATA)
+
+
+# Number of chunks in the collection, kept up to date by ingest_document
+_doc_count = 0
 
 # Ollama configuration - using smallest models for lower resource usage
 OLLAMA_BASE_URL = "http://localhost:11434"
@@ -45,127 +70,426 @@ EMBEDDING_MODEL = "nomic-embed-text"  # Smaller embedding model (~137MB)
 CHAT_MODEL = "tinyllama"  # Smallest chat model (~637MB) - alternative: "llama3.2:1b" (~1.3GB)
 VISION_MODEL = "llava:7b"  # Smaller vision model - if needed, can use smallest available
 
+# Shared HTTP client for all Ollama calls so connections are pooled and kept alive
+OLLAMA_HTTP: Optional[httpx.AsyncClient] = None
+
+# Worker processes for CPU-bound document parsing (PDF / DOCX), created on first use
+# Set UTAS_PDF_WORKERS=0 to parse in a background thread instead
+PDF_WORKERS = int(os.getenv("UTAS_PDF_WORKERS", "2"))
+_pdf_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+
+def _get_pdf_pool() -> Optional[concurrent.futures.ProcessPoolExecutor]:
+    """Return the document parsing pool, creating it on first use."""
+    global _pdf_pool
+    if _pdf_pool is None and PDF_WORKERS > 0:
+        _pdf_pool = concurrent.futures.ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    return _pdf_pool
+
+
+@app.on_event("startup")
+async def open_services():
+    """Open ChromaDB and the Ollama client when the server starts."""
+    # Done here rather than at import: spawned parser workers re-import this module
+    # and must not open a second client on chroma_db
+    global chroma_client, collection, _doc_count, OLLAMA_HTTP, RAG_CACHE_ENABLED
+    chroma_client = chromadb.PersistentClient(
+        path=str(CHROMA_DIR),
+        settings=Settings(anonymized_telemetry=False)
+    )
+    collection = _open_collection("utas_documents")
+    _doc_count = collection.count()
+    
+    OLLAMA_HTTP = httpx.AsyncClient(
+        base_url=OLLAMA_BASE_URL,
+        timeout=httpx.Timeout(300.0, connect=10.0),
+        limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30.0)
+    )
+    
+    if RAG_CACHE_ENABLED and (collection.metadata or {}).get("hnsw:space") != "cosine":
+        # The in-memory path ranks by cosine; it would disagree with an older L2 index.
+        # Metadata is only written at creation, so it reflects the index's real distance.
+        print("WARNING: UTAS_RAG_CACHE ignored because the existing collection does not use cosine distance")
+        RAG_CACHE_ENABLED = False
+
+
+@app.on_event("shutdown")
+async def close_ollama_client():
+    """Close the shared Ollama HTTP client."""
+    if OLLAMA_HTTP is not None:
+        await OLLAMA_HTTP.aclose()
+
+
+@app.on_event("shutdown")
+async def close_pdf_pool():
+    """Shut down the document parsing worker processes."""
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Maximum number of concurrent embedding requests when batch mode is unavailable
+EMBED_SEM = asyncio.Semaphore(int(os.getenv("UTAS_EMBED_CONCURRENCY", "10")))
+
+# Texts per /api/embed request, so large documents don't hit the request timeout
+EMBED_BATCH_SIZE = 64
+# Cleared after the first 404 from an Ollama without /api/embed
+_embed_api_available = True
+
+# Query embedding cache size (exact-match, least recently used entries evicted first)
+EMBED_CACHE_SIZE = 512
+_embed_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+# Semantic query cache: reuse retrieval results for near-duplicate (paraphrased) queries
+QUERY_CACHE_SIZE = 128
+QUERY_CACHE_THRESHOLD = float(os.getenv("UTAS_QUERY_CACHE_THRESHOLD", "0.97"))
+_query_cache: "deque[tuple[np.ndarray, int, List[str]]]" = deque(maxlen=QUERY_CACHE_SIZE)
+
+# In-memory copy of all chunk embeddings for brute-force retrieval on small collections
+# Enable with UTAS_RAG_CACHE=1; otherwise every query goes through ChromaDB
+RAG_CACHE_ENABLED = os.getenv("UTAS_RAG_CACHE", "0") == "1"  # checked against the index at startup
+_cache_mat: Optional[np.ndarray] = None  # float32 unit-length rows used for scoring
+_cache_docs: List[str] = []
+
 # Chunking configuration
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
 
 
-def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
-    """Split text into overlapping chunks."""
-    chunks = []
+def iter_chunks(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> Iterator[str]:
+    """Lazily yield overlapping chunks of text."""
     start = 0
-    while start < len(text):
+    text_len = len(text)
+    while start < text_len:
         end = start + chunk_size
-        chunk = text[start:end]
-        chunks.append(chunk)
-        if end >= len(text):
+        yield text[start:end]
+        if end >= text_len:
             break
         start = end - overlap
-    return chunks
 
 
-async def get_embeddings(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
-    """Get embeddings from Ollama."""
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        try:
-            response = await client.post(
-                f"{OLLAMA_BASE_URL}/api/embeddings",
-                json={"model": model, "prompt": text}
-            )
-            response.raise_for_status()
-            result = response.json()
-            embedding = result.get("embedding", [])
-            if not embedding:
-                raise ValueError("Empty embedding returned from Ollama")
-            return embedding
-        except httpx.ConnectError:
-            print(f"ERROR: Cannot connect to Ollama at {OLLAMA_BASE_URL}. Make sure Ollama is running.")
-            raise
-        except httpx.HTTPStatusError as e:
-            print(f"ERROR: Ollama API error ({e.response.status_code}): {e.response.text}")
-            raise
-        except Exception as e:
-            print(f"ERROR: Error getting embeddings: {e}")
-            # Fallback: return zero vector (nomic-embed-text uses 768 dimensions)
-            # This won't work well for retrieval, but prevents crashes
-            return [0.0] * 768
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """Split text into overlapping chunks."""
+    return list(iter_chunks(text, chunk_size, overlap))
+
+
+async def get_embeddings(text: str, model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Get embeddings from Ollama. Raises on failure rather than returning a placeholder."""
+    if not text.strip():
+        return np.empty(0, dtype=np.float32)
+    try:
+        response = await OLLAMA_HTTP.post(
+            "/api/embeddings",
+            json={"model": model, "prompt": text},
+            timeout=60.0
+        )
+        response.raise_for_status()
+        result = response.json()
+        embedding = result.get("embedding", [])
+        if not embedding:
+            raise ValueError("Empty embedding returned from Ollama")
+        # /api/embeddings returns unnormalized vectors; match /api/embed, which L2-normalizes
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+    except httpx.ConnectError:
+        print(f"ERROR: Cannot connect to Ollama at {OLLAMA_BASE_URL}. Make sure Ollama is running.")
+        raise
+    except httpx.HTTPStatusError as e:
+        print(f"ERROR: Ollama API error ({e.response.status_code}): {e.response.text}")
+        raise
+
+
+async def _post_embed_batch(texts: List[str], model: str) -> Optional[list]:
+    """POST one batch to /api/embed; returns None when the caller should fall back."""
+    global _embed_api_available
+    try:
+        response = await OLLAMA_HTTP.post(
+            "/api/embed",
+            json={"model": model, "input": texts},
+            timeout=120.0
+        )
+        response.raise_for_status()
+        return response.json().get("embeddings")
+    except httpx.ConnectError:
+        print(f"ERROR: Cannot connect to Ollama at {OLLAMA_BASE_URL}. Make sure Ollama is running.")
+        raise
+    except httpx.TimeoutException:
+        print(f"WARNING: Batch embedding of {len(texts)} texts timed out, falling back to per-chunk requests")
+        return None
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            # Older Ollama versions don't have /api/embed - stop trying it
+            print("WARNING: Ollama has no /api/embed endpoint, using per-chunk /api/embeddings requests")
+            _embed_api_available = False
+        else:
+            print(f"WARNING: Batch embedding failed ({e.response.status_code}), falling back to per-chunk requests")
+        return None
+
+
+async def get_embeddings_batch(texts: List[str], model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Get embeddings for several texts via Ollama's batch endpoint, EMBED_BATCH_SIZE at a time."""
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    # Rows must line up with texts, so blank input is rejected rather than dropped
+    if any(not text.strip() for text in texts):
+        raise ValueError("Cannot embed blank text; filter out empty chunks first")
+    
+    async def _one(text: str) -> np.ndarray:
+        async with EMBED_SEM:
+            return await get_embeddings(text, model)
+    
+    blocks = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = texts[start:start + EMBED_BATCH_SIZE]
+        embeddings = await _post_embed_batch(batch, model) if _embed_api_available else None
+        if not embeddings or len(embeddings) != len(batch):
+            # Fallback: embed each text individually, a few requests at a time
+            blocks.append(np.stack(await asyncio.gather(*[_one(text) for text in batch])))
+        else:
+            blocks.append(np.asarray(embeddings, dtype=np.float32))
+    return np.vstack(blocks)
+
+
+async def get_query_embedding(query: str, model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Get the embedding for a query, reusing cached vectors for repeated queries."""
+    key = f"{model}:{hashlib.sha256(query.encode('utf-8')).hexdigest()}"
+    cached = _embed_cache.get(key)
+    if cached is not None:
+        _embed_cache.move_to_end(key)
+        return cached
+    
+    # Same /api/embed path as document chunks so query and chunk vectors are scaled alike
+    if not query.strip():
+        return np.empty(0, dtype=np.float32)
+    embedding = (await get_embeddings_batch([query], model))[0]
+    if embedding.size:
+        _embed_cache[key] = embedding
+        if len(_embed_cache) > EMBED_CACHE_SIZE:
+            _embed_cache.popitem(last=False)
+    return embedding
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+def quantize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """Int8-quantize embeddings after L2 normalization (each row scaled to 127)."""
+    return np.round(_normalize_rows(embeddings) * 127).astype(np.int8)
+
+
+def _encode_q8(row: np.ndarray) -> str:
+    return base64.b64encode(row.tobytes()).decode('ascii')
+
+
+def _decode_q8(q8: str) -> np.ndarray:
+    """Decode a stored int8 row back to an (approximately) unit-length float32 vector."""
+    return np.frombuffer(base64.b64decode(q8), dtype=np.int8).astype(np.float32) / 127
+
+
+async def _ensure_warm():
+    """Build the float32 scoring matrix on first use from the compact q8 metadata."""
+    global _cache_mat, _cache_docs
+    if _cache_mat is not None:
+        return
+    data = collection.get(include=["metadatas", "documents"])
+    if len(data['ids']) == 0:
+        return
+    
+    rows = [None] * len(data['ids'])
+    missing = {}
+    for i, (chunk_id, meta) in enumerate(zip(data['ids'], data['metadatas'])):
+        if meta and "q8" in meta:
+            rows[i] = _decode_q8(meta["q8"])
+        else:
+            missing[chunk_id] = i
+    
+    # Only chunks stored before quantization was added need their full vectors fetched
+    if missing:
+        old = collection.get(ids=list(missing), include=["embeddings"])
+        vectors = _normalize_rows(np.asarray(old['embeddings'], dtype=np.float32))
+        for chunk_id, row in zip(old['ids'], vectors):
+            rows[missing[chunk_id]] = row
+    
+    _cache_mat = np.stack(rows)
+    _cache_docs = list(data['documents'])
+
+
+def _search_cache(query_vec: np.ndarray, top_k: int) -> List[str]:
+    """Return the top_k chunks by cosine similarity from the in-memory matrix."""
+    norm = np.linalg.norm(query_vec)
+    scores = _cache_mat @ (query_vec / (norm if norm else 1.0))
+    k = min(top_k, len(scores))
+    idx = np.argpartition(-scores, k - 1)[:k]
+    idx = idx[np.argsort(-scores[idx])]
+    return [_cache_docs[i] for i in idx]
+
+
+def lookup_query_cache(query_vec: np.ndarray, top_k: int) -> Optional[List[str]]:
+    """Return cached chunks for the most similar previous query above the threshold."""
+    entries = [entry for entry in _query_cache if entry[1] == top_k]
+    if not entries:
+        return None
+    matrix = np.stack([entry[0] for entry in entries])
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vec)
+    sims = (matrix @ query_vec) / np.where(norms == 0, 1.0, norms)
+    best = int(np.argmax(sims))
+    if sims[best] >= QUERY_CACHE_THRESHOLD:
+        return entries[best][2]
+    return None
 
 
 async def describe_image(image_bytes: bytes) -> str:
     """Use Ollama vision model to describe an image."""
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        try:
-            # Convert image to base64
-            import base64
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-            
-            response = await client.post(
-                f"{OLLAMA_BASE_URL}/api/generate",
-                json={
-                    "model": VISION_MODEL,
-                    "prompt": "Describe this image in detail, focusing on any text, diagrams, or important visual elements. Be thorough and specific.",
-                    "images": [image_b64],
-                    "stream": False
-                }
-            )
-            response.raise_for_status()
-            result = response.json()
-            return result.get("response", "Image description unavailable")
-        except Exception as e:
-            print(f"Error describing image: {e}")
-            return f"Error processing image: {str(e)}"
+    try:
+        # Convert image to base64
+        image_b64 = base64.b64encode(image_bytes).decode('ascii')
+        
+        # Pre-serialize with orjson; stdlib json is slow on the large base64 string
+        response = await OLLAMA_HTTP.post(
+            "/api/generate",
+            content=orjson.dumps({
+                "model": VISION_MODEL,
+                "prompt": "Describe this image in detail, focusing on any text, diagrams, or important visual elements. Be thorough and specific.",
+                "images": [image_b64],
+                "stream": False
+            }),
+            headers={"Content-Type": "application/json"},
+            timeout=120.0
+        )
+        response.raise_for_status()
+        result = response.json()
+        return result.get("response", "Image description unavailable")
+    except Exception as e:
+        print(f"Error describing image: {e}")
+        return f"Error processing image: {str(e)}"
+
+
+async def _run_parser(parser: Callable[[str], str], file_path: Path) -> str:
+    """Run a blocking parser off the event loop (process pool, or a thread if disabled)."""
+    global _pdf_pool
+    pool = _get_pdf_pool()
+    if pool is None:
+        return await asyncio.to_thread(parser, str(file_path))
+    
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, parser, str(file_path))
+    except concurrent.futures.BrokenExecutor:
+        # A worker died (likely on this file); don't retry in-process, and start a fresh pool next time
+        print(f"ERROR: Document parser worker crashed while reading {file_path.name}")
+        if _pdf_pool is pool:
+            _pdf_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise RuntimeError("The document parser crashed on this file") from None
+
+
+async def _extract_pdf_async(file_path: Path, filename: str) -> str:
+    return await _run_parser(extract_pdf, file_path)
+
+
+async def _extract_docx_async(file_path: Path, filename: str) -> str:
+    return await _run_parser(extract_docx, file_path)
+
+
+async def _decode_text(file_path: Path, filename: str) -> str:
+    content = await run_in_threadpool(file_path.read_bytes)
+    return content.decode('utf-8', errors='ignore')
+
+
+# Text extractors keyed by lowercase file extension
+EXT_HANDLERS: dict[str, Callable[[Path, str], Awaitable[str]]] = {
+    ".pdf": _extract_pdf_async,
+    ".docx": _extract_docx_async,
+    ".txt": _decode_text,
+    ".md": _decode_text,
+}
+IMG_EXTS = {".png", ".jpg", ".jpeg"}
 
 
-async def process_text_file(content: bytes, filename: str) -> str:
+async def process_text_file(file_path: Path, filename: str, file_ext: Optional[str] = None) -> str:
     """Extract text from various text file formats."""
-    if filename.endswith('.pdf'):
-        with pdfplumber.open(io.BytesIO(content)) as pdf:
-            text = "\n".join([page.extract_text() or "" for page in pdf.pages])
-            return text
-    elif filename.endswith('.docx'):
-        doc = docx.Document(io.BytesIO(content))
-        return "\n".join([para.text for para in doc.paragraphs])
-    elif filename.endswith(('.txt', '.md')):
-        return content.decode('utf-8', errors='ignore')
-    else:
-        return content.decode('utf-8', errors='ignore')
-
-
-async def process_image_file(content: bytes) -> str:
+    if file_ext is None:
+        file_ext = Path(filename).suffix.lower()
+    return await EXT_HANDLERS.get(file_ext, _decode_text)(file_path, filename)
+
+
+async def process_image_file(file_path: Path) -> str:
     """Process image and get description from Ollama vision model."""
+    content = await run_in_threadpool(file_path.read_bytes)
     return await describe_image(content)
 
 
+def _save_upload(upload: UploadFile, file_path: Path):
+    """Copy an uploaded file to disk in fixed-size blocks."""
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(upload.file, f, length=1024 * 1024)
+
+
 async def ingest_document(file_id: str, text: str, filename: str):
     """Ingest document into ChromaDB with embeddings."""
-    chunks = chunk_text(text)
+    global _doc_count, _cache_mat
+    chunks = list(iter_chunks(text))
     
     if not chunks:
         return
     
-    # Generate embeddings for all chunks
-    embeddings = []
-    ids = []
-    metadatas = []
-    documents = []
-    
+    # Content-address chunks so identical text is only embedded and stored once
+    new_chunks = {}
     for i, chunk in enumerate(chunks):
-        chunk_id = f"{file_id}_{i}"
-        embedding = await get_embeddings(chunk)
-        
-        ids.append(chunk_id)
-        embeddings.append(embedding)
-        metadatas.append({"filename": filename, "chunk_index": i})
-        documents.append(chunk)
+        if not chunk.strip():
+            continue
+        chunk_hash = hashlib.sha256(chunk.encode('utf-8')).hexdigest()
+        if chunk_hash not in new_chunks:
+            new_chunks[chunk_hash] = (i, chunk)
+    
+    if not new_chunks:
+        return
+    
+    existing = collection.get(ids=list(new_chunks), include=[])
+    for chunk_hash in existing['ids']:
+        new_chunks.pop(chunk_hash, None)
+    
+    if not new_chunks:
+        return
+    
+    # Generate embeddings for the new chunks in a single batch request
+    n = len(new_chunks)
+    ids = [None] * n
+    metadatas = [None] * n
+    documents = [None] * n
+    for j, (chunk_hash, (i, chunk)) in enumerate(new_chunks.items()):
+        ids[j] = chunk_hash
+        metadatas[j] = {"filename": filename, "file_id": file_id, "chunk_index": i}
+        documents[j] = chunk
+    try:
+        embeddings = await get_embeddings_batch(documents)
+    except Exception as e:
+        # Never store placeholder vectors; skip this file and let the caller report it
+        print(f"ERROR: Embedding failed for {filename}, nothing was added: {e}")
+        raise
     
-    # Add to ChromaDB
-    if embeddings:
-        collection.add(
+    # Keep a compact int8 copy of each vector alongside the float32 one Chroma indexes
+    quantized = quantize_embeddings(embeddings)
+    for j, row in enumerate(quantized):
+        metadatas[j]["q8"] = _encode_q8(row)
+    
+    # Add to ChromaDB (upsert in case the same chunk was added concurrently)
+    if len(embeddings):
+        collection.upsert(
             ids=ids,
             embeddings=embeddings,
             metadatas=metadatas,
             documents=documents
         )
+        _doc_count += len(ids)
+        # Append new rows to the warm matrix instead of reloading it
+        if _cache_mat is not None:
+            _cache_mat = np.vstack([_cache_mat, _normalize_rows(embeddings)])
+            _cache_docs.extend(documents)
+        # New documents can change results for any query
+        _query_cache.clear()
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -178,27 +502,24 @@ async def root(request: Request):
 async def upload_file(file: UploadFile = File(...)):
     """Handle file uploads and trigger ingestion."""
     # Validate file type
-    allowed_extensions = {'.pdf', '.txt', '.md', '.docx', '.png', '.jpg', '.jpeg'}
     file_ext = Path(file.filename).suffix.lower()
     
-    if file_ext not in allowed_extensions:
+    if file_ext not in EXT_HANDLERS and file_ext not in IMG_EXTS:
         raise HTTPException(status_code=400, detail=f"File type {file_ext} not supported")
     
     # Generate unique file ID
     file_id = str(uuid.uuid4())
     
-    # Save file
-    content = await file.read()
+    # Save file (streamed to disk so large uploads aren't held in memory)
     file_path = UPLOAD_DIR / f"{file_id}_{file.filename}"
-    with open(file_path, "wb") as f:
-        f.write(content)
+    await run_in_threadpool(_save_upload, file, file_path)
     
     # Process file
     try:
-        if file_ext in {'.png', '.jpg', '.jpeg'}:
-            text = await process_image_file(content)
+        if file_ext in IMG_EXTS:
+            text = await process_image_file(file_path)
         else:
-            text = await process_text_file(content, file.filename)
+            text = await process_text_file(file_path, file.filename, file_ext)
         
         if not text.strip():
             return {"status": "error", "message": "No text content extracted from file"}
@@ -223,135 +544,149 @@ async def retrieve_relevant_chunks(query: str, top_k: int = 5) -> List[str]:
     """Retrieve relevant chunks from ChromaDB."""
     try:
         # Check if collection has any data
-        count = collection.count()
-        if count == 0:
+        if _doc_count == 0:
             return []
         
         # Get query embedding
-        query_embedding = await get_embeddings(query)
+        query_vec = await get_query_embedding(query)
+        if query_vec.size == 0:
+            return []
+        
+        # Reuse results from a near-identical earlier query
+        cached = lookup_query_cache(query_vec, top_k)
+        if cached is not None:
+            return cached
+        
+        # Small collections: brute-force over the in-memory matrix
+        if RAG_CACHE_ENABLED:
+            await _ensure_warm()
+            if _cache_mat is not None:
+                chunks = _search_cache(query_vec, top_k)
+                _query_cache.append((query_vec, top_k, chunks))
+                return chunks
         
         # Query ChromaDB
         results = collection.query(
-            query_embeddings=[query_embedding],
+            query_embeddings=query_vec[None, :],
             n_results=top_k
         )
         
         if results['documents'] and len(results['documents'][0]) > 0:
-            return results['documents'][0]
+            chunks = results['documents'][0]
+            _query_cache.append((query_vec, top_k, chunks))
+            return chunks
         return []
     except Exception as e:
         print(f"Error retrieving chunks: {e}")
         return []
 
 
-def build_prompt(query: str, context_chunks: List[str], action_type: Optional[str] = None, use_rag: bool = True) -> str:
-    """Build the final prompt with context and query. Supports both RAG and direct modes."""
-    
-    if use_rag and context_chunks:
-        # RAG Mode: Use context from uploaded documents
-        context = "\n\n".join(context_chunks)
-        system_prompt = """You are a helpful AI assistant for engineering students. You help them understand their academic materials, answer questions, and provide insights based on the documents they have uploaded.
+_RAG_SYSTEM_PROMPT = """You are a helpful AI assistant for engineering students. You help them understand their academic materials, answer questions, and provide insights based on the documents they have uploaded.
 
 Use the following context from their uploaded documents to answer their questions accurately and helpfully. If the context doesn't contain relevant information, you can supplement with your general knowledge."""
-        
-        if action_type == "summarize":
-            user_prompt = f"""Based on the following context from the uploaded documents, provide a comprehensive summary.
+
+_DIRECT_SYSTEM_PROMPT = """You are a helpful AI assistant for engineering students. You help them understand concepts, answer questions, and provide insights. Be thorough, accurate, and educational in your responses."""
+
+# (use_rag, action_type) -> (system prompt, user prompt template with {context} / {query})
+_PROMPT_TEMPLATES: dict[tuple[bool, Optional[str]], tuple[str, str]] = {
+    # RAG Mode: Use context from uploaded documents
+    (True, "summarize"): (_RAG_SYSTEM_PROMPT, """Based on the following context from the uploaded documents, provide a comprehensive summary.
 
 Context:
 {context}
 
-Please provide a clear, well-structured summary of the key points and main ideas."""
-        
-        elif action_type == "suggest_projects":
-            user_prompt = f"""Based on the following context from the uploaded documents, suggest practical project ideas that would help the student apply and deepen their understanding of these concepts.
+Please provide a clear, well-structured summary of the key points and main ideas."""),
+    (True, "suggest_projects"): (_RAG_SYSTEM_PROMPT, """Based on the following context from the uploaded documents, suggest practical project ideas that would help the student apply and deepen their understanding of these concepts.
 
 Context:
 {context}
 
-Provide creative, actionable project suggestions that relate to the material."""
-        
-        elif action_type == "explain":
-            user_prompt = f"""Based on the following context from the uploaded documents, explain the concepts mentioned in the user's query in a clear and educational way.
+Provide creative, actionable project suggestions that relate to the material."""),
+    (True, "explain"): (_RAG_SYSTEM_PROMPT, """Based on the following context from the uploaded documents, explain the concepts mentioned in the user's query in a clear and educational way.
 
 Context:
 {context}
 
 User Query: {query}
 
-Provide a detailed explanation that helps the student understand the concept."""
-        
-        else:
-            user_prompt = f"""Context from uploaded documents:
+Provide a detailed explanation that helps the student understand the concept."""),
+    (True, None): (_RAG_SYSTEM_PROMPT, """Context from uploaded documents:
 {context}
 
 User Question: {query}
 
-Please answer the user's question based on the provided context. If the context is insufficient, use your general knowledge to provide a helpful answer."""
-        
-        return f"{system_prompt}\n\n{user_prompt}"
-    else:
-        # Direct Mode: No context, just answer with general knowledge
-        system_prompt = """You are a helpful AI assistant for engineering students. You help them understand concepts, answer questions, and provide insights. Be thorough, accurate, and educational in your responses."""
-        
-        if action_type == "summarize":
-            user_prompt = f"""The user is asking for a summary. Please provide a helpful response to: {query}"""
-        elif action_type == "suggest_projects":
-            user_prompt = f"""Suggest practical project ideas related to: {query}. Provide creative, actionable project suggestions."""
-        elif action_type == "explain":
-            user_prompt = f"""Explain the following concept in a clear and educational way: {query}. Provide a detailed explanation that helps the student understand."""
-        else:
-            user_prompt = f"""User Question: {query}
+Please answer the user's question based on the provided context. If the context is insufficient, use your general knowledge to provide a helpful answer."""),
+    # Direct Mode: No context, just answer with general knowledge
+    (False, "summarize"): (_DIRECT_SYSTEM_PROMPT, """The user is asking for a summary. Please provide a helpful response to: {query}"""),
+    (False, "suggest_projects"): (_DIRECT_SYSTEM_PROMPT, """Suggest practical project ideas related to: {query}. Provide creative, actionable project suggestions."""),
+    (False, "explain"): (_DIRECT_SYSTEM_PROMPT, """Explain the following concept in a clear and educational way: {query}. Provide a detailed explanation that helps the student understand."""),
+    (False, None): (_DIRECT_SYSTEM_PROMPT, """User Question: {query}
 
-Please answer the user's question. Be thorough, accurate, and helpful."""
-        
-        return f"{system_prompt}\n\n{user_prompt}"
+Please answer the user's question. Be thorough, accurate, and helpful."""),
+}
+
+
+def build_prompt(query: str, context_chunks: List[str], action_type: Optional[str] = None, use_rag: bool = True) -> str:
+    """Build the final prompt with context and query. Supports both RAG and direct modes."""
+    rag = bool(use_rag and context_chunks)
+    system_prompt, user_template = _PROMPT_TEMPLATES.get((rag, action_type), _PROMPT_TEMPLATES[(rag, None)])
+    context = "\n\n".join(context_chunks) if rag else ""
+    return f"{system_prompt}\n\n{user_template.format(context=context, query=query)}"
+
+
+async def _iter_ndjson_lines(response: httpx.Response):
+    """Yield raw newline-delimited lines from a streamed response as bytes."""
+    buf = bytearray()
+    async for chunk in response.aiter_bytes():
+        buf.extend(chunk)
+        while (i := buf.find(b"\n")) != -1:
+            line = bytes(buf[:i])
+            del buf[:i + 1]
+            yield line
+    if buf:
+        yield bytes(buf)
 
 
 async def stream_ollama_response(prompt: str):
     """Stream response from Ollama."""
-    async with httpx.AsyncClient(timeout=300.0) as client:
-        try:
-            async with client.stream(
-                "POST",
-                f"{OLLAMA_BASE_URL}/api/generate",
-                json={
-                    "model": CHAT_MODEL,
-                    "prompt": prompt,
-                    "stream": True
-                }
-            ) as response:
-                response.raise_for_status()
-                async for line in response.aiter_lines():
-                    if line:
-                        try:
-                            data = json.loads(line)
-                            if "response" in data:
-                                yield f"data: {json.dumps({'chunk': data['response']})}\n\n"
-                            if data.get("done", False):
-                                yield f"data: {json.dumps({'done': True})}\n\n"
-                                break
-                        except json.JSONDecodeError:
-                            continue
-        except httpx.ConnectError:
-            error_msg = f"Cannot connect to Ollama at {OLLAMA_BASE_URL}. Make sure Ollama is running and the model '{CHAT_MODEL}' is installed."
-            yield f"data: {json.dumps({'error': error_msg})}\n\n"
-        except httpx.HTTPStatusError as e:
-            error_msg = f"Ollama API error ({e.response.status_code}): {e.response.text}"
-            yield f"data: {json.dumps({'error': error_msg})}\n\n"
-        except Exception as e:
-            error_msg = f"Error communicating with Ollama: {str(e)}"
-            yield f"data: {json.dumps({'error': error_msg})}\n\n"
+    try:
+        async with OLLAMA_HTTP.stream(
+            "POST",
+            "/api/generate",
+            json={
+                "model": CHAT_MODEL,
+                "prompt": prompt,
+                "stream": True
+            }
+        ) as response:
+            response.raise_for_status()
+            async for line in _iter_ndjson_lines(response):
+                if line.strip():
+                    try:
+                        data = orjson.loads(line)
+                        if "response" in data:
+                            yield b"data: " + orjson.dumps({"chunk": data["response"]}) + b"\n\n"
+                        if data.get("done", False):
+                            yield b"data: " + orjson.dumps({"done": True}) + b"\n\n"
+                            break
+                    except orjson.JSONDecodeError:
+                        continue
+    except httpx.ConnectError:
+        error_msg = f"Cannot connect to Ollama at {OLLAMA_BASE_URL}. Make sure Ollama is running and the model '{CHAT_MODEL}' is installed."
+        yield b"data: " + orjson.dumps({"error": error_msg}) + b"\n\n"
+    except httpx.HTTPStatusError as e:
+        error_msg = f"Ollama API error ({e.response.status_code}): {e.response.text}"
+        yield b"data: " + orjson.dumps({"error": error_msg}) + b"\n\n"
+    except Exception as e:
+        error_msg = f"Error communicating with Ollama: {str(e)}"
+        yield b"data: " + orjson.dumps({"error": error_msg}) + b"\n\n"
 
 
 @app.post("/chat")
 async def chat(message: str = Form(...), action: Optional[str] = Form(None)):
     """Handle chat messages and stream responses. Supports both RAG and direct modes."""
     # Check if we have any documents in the collection
-    try:
-        doc_count = collection.count()
-        has_documents = doc_count > 0
-    except:
-        has_documents = False
+    has_documents = _doc_count > 0
     
     # Retrieve relevant chunks if documents exist
     context_chunks = []
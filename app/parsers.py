@@ -0,0 +1,22 @@
+"""Document text extractors run in worker processes.
+
+Kept separate from main.py so the functions sent to workers only depend on
+pdfplumber and python-docx. With the spawn start method (Windows), each worker
+still re-imports main.py as __mp_main__, so its libraries load there too; the
+ChromaDB client and the Ollama HTTP client are only opened in main.py's
+startup hook, which workers never run.
+"""
+import pdfplumber
+import docx
+
+
+def extract_pdf(path: str) -> str:
+    """Extract text from a PDF."""
+    with pdfplumber.open(path) as pdf:
+        return "\n".join([page.extract_text() or "" for page in pdf.pages])
+
+
+def extract_docx(path: str) -> str:
+    """Extract text from a DOCX file."""
+    doc = docx.Document(path)
+    return "\n".join([para.text for para in doc.paragraphs])
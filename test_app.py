@@ -30,6 +30,12 @@ def test_imports():
         import httpx
         print("[OK] httpx import OK")
         
+        import numpy
+        print("[OK] numpy import OK")
+        
+        import orjson
+        print("[OK] orjson import OK")
+        
         return True
     except Exception as e:
         print(f"[ERROR] Import error: {e}")